@@ -147,7 +147,7 @@ The protocol is as follows:
 import sys
 import serial
 import time
-import array
+import struct
 import codecs
 import logging
 import argparse
@@ -162,6 +162,12 @@ Default_Timeout = 10
 
 _LOGGER = logging.getLogger(__name__)
 
+# Preallocated single-byte bytes objects, indexed by value.
+_BYTES = tuple(bytes((i,)) for i in range(256))
+
+# Page number sent before each FLASH page, MSB first.
+_PAGE_NUMBER = struct.Struct('>H')
+
 ##############################################################################
 
 Processors = {0x41: 'ATmega8',
@@ -232,6 +238,18 @@ EEPROMSize = {
     0x34: 4096
 }
 
+
+def _byte_table(lookup):
+    """Turn a byte-keyed dict into a tuple indexed by byte value.
+
+    Unused entries are None.
+    """
+    table = [None] * 256
+    for c, value in lookup.items():
+        table[c] = value
+    return tuple(table)
+
+
 PROCINFO_ORDER_DEFAULT = [
     "proc",
     "flash",
@@ -256,8 +274,14 @@ def openDevice(options):
     # Two stop bits seems to work better in some cases.
     dev.stopbits = 2
     dev.timeout = 3
+    # Fail instead of blocking forever if the port stops accepting data.
+    dev.write_timeout = 3
 
     dev.open()
+    # pyserial already puts POSIX ports into raw mode. On Windows, enlarge
+    # the driver buffers so that whole pages are queued in one go.
+    if hasattr(dev, 'set_buffer_size'):
+        dev.set_buffer_size(rx_size=1 << 16, tx_size=1 << 16)
     _LOGGER.info(f"Opened {options.DevicePort} ...")
 
     return dev
@@ -278,6 +302,17 @@ class Proc:
     class BadCharacter(Exception):
         pass
 
+    # (attribute, value) for every byte the bootloader may send as processor
+    # information, None for anything else. BootSize is reported in WORDS, it
+    # is converted to bytes here.
+    _DECODE_TABLE = _byte_table({
+        **{c: ("proc", name) for c, name in Processors.items()},
+        **{c: ("flash", size) for c, size in FlashSize.items()},
+        **{c: ("boot", words*2) for c, words in BootSize.items()},
+        **{c: ("page", size) for c, size in PageSize.items()},
+        **{c: ("eeprom", size) for c, size in EEPROMSize.items()},
+    })
+
     def __init__(self):
         self.loaderversion = None  # needs to be set externally
         self.proc = None
@@ -286,48 +321,37 @@ class Proc:
         self.boot = None
         self.eeprom = None
         self.order_received = []
+        # attributes not yet received from the bootloader
+        self._missing = set(PROCINFO_ORDER_DEFAULT)
 
-    def decode_character(self, character):
-        """Decode character / byte sent by bootloader to processor attributes.
+    def decode_character(self, c):
+        """Decode byte (int) sent by bootloader to processor attributes.
 
         This only detects things like flash size. It does send anything to the
         bootloader, so it cannot handle the initial sync.
         """
-        _LOGGER.debug(f"Decoding character {character}")
-        c = ord(character)
+        _LOGGER.debug(f"Decoding character {c:#04x}")
 
         # no character / byte has multiple meanings, so we don't have to check
         # order_received every time we receive something. We can just raise
         # an exception in is_valid.
 
-        steps = [
-            ("proc", Processors),
-            ("page", PageSize),
-            ("flash", FlashSize),
-            # boot needs to be handled separately
-            ("eeprom", EEPROMSize),
-        ]
-
-        # boot needs to be handled separately because it needs to be
-        # multiplied by 2.
-        if c in BootSize and self.boot is None:
-            # *2 because BootSize is in WORDS
-            self.boot = BootSize[c]*2
-            self.order_received.append("boot")
-            _LOGGER.debug(f"Got boot: {self.boot}")  # this is NOT in WORDS
-            return "boot"
-
-        for variable, lookup_table in steps:
-            if c in lookup_table and getattr(self, variable) is None:
-                setattr(self, variable, lookup_table[c])
+        entry = self._DECODE_TABLE[c]
+        if entry is not None:
+            variable, value = entry
+            if getattr(self, variable) is None:
+                setattr(self, variable, value)
                 self.order_received.append(variable)
-                _LOGGER.debug(f"Got {variable}: {getattr(self, variable)}")
+                self._missing.discard(variable)
+                _LOGGER.debug(f"Got {variable}: {value}")
                 return variable
 
-        raise self.BadCharacter(f"Unknown character: {character}")
+        raise self.BadCharacter(f"Unknown character: {c:#04x}")
 
     def is_complete(self, expected_order=None):
-        """Return True if we have all the information.
+        """Return True if we have received all the information.
+
+        Only attributes decoded by decode_character are taken into account.
 
         Raises BadOrder if expected_order is provided and does not match
         order_received.
@@ -336,12 +360,7 @@ class Proc:
             raise self.BadOrder(
                     f"Expected {expected_order}; got {self.order_received}")
 
-        if any(a is None for a in [self.proc, self.page, self.flash,
-                                   self.boot, self.eeprom]
-               ):
-            return False
-
-        return True
+        return not self._missing
 
 
 def doConnect(options):
@@ -355,66 +374,69 @@ def doConnect(options):
 
     P = Proc()
 
-    tic = time.time()
-    while (time.time()-tic) < options.Timeout:
-        c = options.dev.read(1)
-        if not c:
+    deadline = time.monotonic() + options.Timeout
+    while time.monotonic() < deadline:
+        # Drain everything that is already waiting; the bootloader sends the
+        # processor information back-to-back.
+        chunk = options.dev.read(max(1, options.dev.in_waiting))
+        if not chunk:
             if options.Verbose:
                 sys.stdout.write('.')
                 sys.stdout.flush()
             continue
 
-        _LOGGER.debug(f"char received: {c}")
-
-        if state == CONNECT:
-            if ord(c) == 0x55:  # For MegaLoad 4 and 5
-                options.dev.write(b'\x55')
-                state = SYNCED4
-                P.loaderversion = 4
-                continue
-            elif ord(c) == 0x3E:  # For MegaLoad 3
-                options.dev.write(b'\x3C')
-                state = SYNCED3    # Maybe it's just junk, though, from a MegaLoad 4 bootloader
-                P.loaderversion = 3
-                _LOGGER.debug("MegaLoad 3 detected")
-                continue
-
-        # We could keep getting 0x55's from a MegaLoad 4 bootloader that
-        # is doing auto-OSCCAL, or we got '>' from MegaLoad 5.
-        if state == SYNCED4:
-            if ord(c) == 0x55:    # We're in auto-OSCCAL
-                continue
-            elif ord(c) == 0x3E:  # MegaLoad 5 sends '>'
-                options.dev.write('\x3C')
-                P.loaderversion = 5
-                continue
-
-        if state in (SYNCED3, SYNCED4):
-            try:
+        for c in chunk:  # c is an int
+            _LOGGER.debug(f"char received: {c:#04x}")
+
+            if state == CONNECT:
+                if c == 0x55:  # For MegaLoad 4 and 5
+                    options.dev.write(b'\x55')
+                    state = SYNCED4
+                    P.loaderversion = 4
+                    continue
+                elif c == 0x3E:  # For MegaLoad 3
+                    options.dev.write(b'\x3C')
+                    state = SYNCED3    # Maybe it's just junk, though, from a MegaLoad 4 bootloader
+                    P.loaderversion = 3
+                    _LOGGER.debug("MegaLoad 3 detected")
+                    continue
+
+            # We could keep getting 0x55's from a MegaLoad 4 bootloader that
+            # is doing auto-OSCCAL, or we got '>' from MegaLoad 5.
+            if state == SYNCED4:
+                if c == 0x55:    # We're in auto-OSCCAL
+                    continue
+                elif c == 0x3E:  # MegaLoad 5 sends '>'
+                    options.dev.write(b'\x3C')
+                    P.loaderversion = 5
+                    continue
+
+            if state in (SYNCED3, SYNCED4):
+                try:
+                    P.decode_character(c)
+                    state = INFO
+                except Proc.BadCharacter:
+                    # Nope...we've just got garbage.
+                    _LOGGER.debug(f"Got garbage: {c:#04x}")
+                    state = CONNECT
+                finally:
+                    continue
+
+            if state != GOTALL:
                 P.decode_character(c)
-                state = INFO
-            except Proc.BadCharacter:
-                # Nope...we've just got garbage.
-                _LOGGER.debug(f"Got garbage: {c}")
-                state = CONNECT
-            finally:
-                continue
-
-        if state != GOTALL:
-            P.decode_character(c)
-            # we don't check expected_order yet
-            if P.is_complete():
-                state = GOTALL
-                continue
-
-        if state == GOTALL:
-            if ord(c) == 0x21:         # '!' means we're all done
-                # just check expected_order; it will for sure return True
-                P.is_complete(expected_order=options.procinfo_order)
-                _LOGGER.info(f'Using MegaLoad {P.loaderversion} protocol ...')
-                return P
-            elif ord(c) == 0x3E:     # '>' is MegaLoad 4, and comes before '!'
-                continue
+                # we don't check expected_order yet
+                if P.is_complete():
+                    state = GOTALL
+                    continue
+
+            if state == GOTALL:
+                if c == 0x21:         # '!' means we're all done
+                    # just check expected_order; it will for sure return True
+                    P.is_complete(expected_order=options.procinfo_order)
+                    _LOGGER.info(f'Using MegaLoad {P.loaderversion} protocol ...')
+                    return P
+                elif c == 0x3E:     # '>' is MegaLoad 4, and comes before '!'
+                    continue
 
     _LOGGER.error('*** Timeout waiting for bootloader to connect')
     return None
@@ -426,9 +448,9 @@ def downloadFlash(options, proc, hex_data):
     #     - make sure flash is an integer number of pages
     #     - make sure boot section is an integer number of pages
 
-    lastAddr = max(hex_data)
+    lastAddr = len(hex_data) - 1
 
-    if lastAddr > (proc.flash - proc.boot):
+    if lastAddr >= (proc.flash - proc.boot):
         print('*** HEX file contents extends into bootloader')
         return 0
 
@@ -444,90 +466,92 @@ def downloadFlash(options, proc, hex_data):
 
     emptypage = b'\xFF'*proc.page
 
-    if options.Debug:
+    # hex_data already is a contiguous image starting at address 0; pad it
+    # to the whole application section so that every page is a full slice.
+    image = bytearray(hex_data)
+    image += b'\xFF' * (proc.flash - proc.boot - len(image))
+
+    # Looked up on every page, so keep them in locals.
+    pagesize = proc.page
+    verbose = options.Verbose
+    debug = options.Debug
+    if debug:
         dumpfid = open('dump.txt', 'wt')
+    else:
+        dev_write = options.dev.write
+        dev_read = options.dev.read
 
     for pagenum in range(NumPages):
-        startAddr = pagenum*proc.page
-        endAddr = startAddr + proc.page
+        startAddr = pagenum*pagesize
+        endAddr = startAddr + pagesize
 
-        if options.Verbose:
+        if verbose:
             print(f"\r        Page {pagenum} ...",)
             sys.stdout.flush()
 
-        page = array.array('B', emptypage)
-
-        has_data = False
-        for addr in range(startAddr, endAddr):
-            if addr in hex_data:
-                page[addr - startAddr] = hex_data[addr]
-                has_data = True
-
-        if not has_data:
-            # Next byte to write is past this page
+        towrite = image[startAddr:endAddr]
+        if towrite == emptypage:
+            # Nothing but erased (0xFF) bytes in this page
             continue
 
-        towrite = page.tobytes()
-
-        if towrite != emptypage:
-            for tries in range(3):
-                if options.Debug:
-                    print('Page:', pagenum, file=dumpfid)
-                    for ix in range(len(towrite)):
-                        print('%02X ' % towrite[ix], file=dumpfid)
-                        if (ix & 0x0F) == 0x0F:
-                            print("", file=dumpfid)
-                else:
-                    options.dev.write(bytes([(pagenum >> 8) & 0xFF]))
-                    options.dev.write(bytes([pagenum & 0xFF]))
-                    options.dev.write(towrite)
-
-                checksum = 0
-                for ix in range(len(towrite)):
-                    checksum += towrite[ix]
-
-                if options.Debug:
-                    print("Checksum:", hex(checksum & 0xFF), file=dumpfid)
-                else:
-                    _LOGGER.debug(f"Writing checksum: {checksum & 0xFF}")
-                    options.dev.write(bytes([checksum & 0xFF]))
-
-                if options.Debug:
-                    if 0:
-                        print('Response to page #%d' % pagenum, '(! or @ or Enter):')
-                        s = input()
-                        if s:
-                            c = ord(s[0])
-                        else:
-                            c = None
+        checksum = sum(towrite) & 0xFF
+        # Page number (MSB first), page data and checksum are sent in a
+        # single write so that they can go out in as few USB transfers as
+        # possible. Retries resend the very same packet.
+        packet = b''.join((_PAGE_NUMBER.pack(pagenum), towrite,
+                           _BYTES[checksum]))
+
+        if debug:
+            print('Page:', pagenum, file=dumpfid)
+            # 16 bytes per line
+            print('\n'.join(towrite[ix:ix+16].hex(' ').upper()
+                            for ix in range(0, len(towrite), 16)),
+                  file=dumpfid)
+            print("Checksum:", hex(checksum), file=dumpfid)
+
+        written = False
+        for _ in range(3):
+            if debug:
+                if 0:
+                    print('Response to page #%d' % pagenum, '(! or @ or Enter):')
+                    s = input()
+                    if s:
+                        c = ord(s[0])
                     else:
-                        c = ord('!')
+                        c = None
                 else:
-                    c = options.dev.read(1)
-                    c = ord(c) if c else None
-
-                if c is not None:
-                    if c == 0x21:
-                        break     # successful write
-                    elif c == 0x40:
-                        if options.Verbose:
-                            print('failed')
-                            print(f"\r        Page {pagenum} ...",)
-                            sys.stdout.flush()
-                    else:
-                        print('\n*** Unexpected response %02X to FLASH page write' % c)
-                        return 0
+                    c = ord('!')
+            else:
+                _LOGGER.debug(f"Writing checksum: {checksum}")
+                dev_write(packet)
+                c = dev_read(1)
+                c = ord(c) if c else None
+
+            if c is not None:
+                if c == 0x21:
+                    written = True
+                    break     # successful write
+                elif c == 0x40:
+                    if verbose:
+                        print('failed')
+                        print(f"\r        Page {pagenum} ...",)
+                        sys.stdout.flush()
                 else:
-                    print('\n*** No response from bootloader')
+                    print('\n*** Unexpected response %02X to FLASH page write' % c)
                     return 0
             else:
-                print('\n*** Giving up after 3 tries')
+                print('\n*** No response from bootloader')
                 return 0
 
+        if not written:
+            print('\n*** Giving up after 3 tries')
+            return 0
+
     # Flash writing is all done...we must send a page number of 0xFFFF
-    options.dev.write(b'\xFF\xFF')
+    if not debug:
+        dev_write(b'\xFF\xFF')
 
-    if options.Verbose:
+    if verbose:
         print()
     return 1
 
@@ -577,7 +601,9 @@ Grand Valley State University
         sys.exit(0)
 
     ih = IntelHex(options.programfile)
-    hex_data = ih.todict()
+    # Contiguous image from address 0, gaps filled with erased flash
+    ih.padding = 0xFF
+    hex_data = ih.tobinarray(start=0)
     if not hex_data:
         print('*** HEX file is empty...nothing to download')
         sys.exit(1)